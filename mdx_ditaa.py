@@ -25,117 +25,232 @@ A Python Markdown extension to convert plain-text diagrams to images.
 # THE SOFTWARE.
 
 
-import ctypes
+import collections
+import concurrent.futures
+import hashlib
+import logging
 import os
-import platform
+import re
 import shutil
 import subprocess
 import tempfile
-import zlib
+import threading
+import time
 
 from markdown.preprocessors import Preprocessor
 from markdown.extensions import Extension
 
 
-if platform.python_version_tuple() >= ('3', '0', '0'):
-    def b(string):
-        return bytes(string, "UTF-8")
-else:
-    def b(string):
-        return string
+logger = logging.getLogger(__name__)
+
+
+# opening line of a diagram, may be nested within a list item or a blockquote
+_DITAA_RE = re.compile(r'^([ \t>]*)```ditaa(?:\s+path=(.+?))?\s*$')
+
+
+# Images generated or verified by this process, shared by all preprocessor
+# instances. Only the keys (image paths) are used, as an ordered set.
+MEMO_SIZE = 4096
+_memo = collections.OrderedDict()
+_memo_lock = threading.Lock()
+
+# Diagrams ditaa failed to generate: (ditaa_cmd, image path) -> time of the
+# failure. They are not retried for FAILED_TTL seconds.
+FAILED_TTL = 60
+_failed = {}
 
 
 class DitaaPreprocessor(Preprocessor):
 
     def __init__(self, *args, **config):
         self.config = config
+        self._cwd = None
+
+    def _settings(self):
+        """
+        Read settings and the working directory once, they do not change
+        while converting a document.
+        """
+        self._cwd = os.getcwd()
+        self._ditaa_cmd = self.config['ditaa_cmd']
+        self._image_dir = self.config['ditaa_image_dir']
+        self._extra_copy = self.config.get('extra_copy_path')
 
     def generate_image_path(self, plaintext):
         """
-        Return an image path based on a hash of the plaintext input.
+        Return an image path and file name based on a hash of the plaintext
+        input.
+        """
+        if self._cwd is None:
+            self._settings()
+        digest = hashlib.blake2b(plaintext.encode("utf-8"), digest_size=8).hexdigest()
+        img_basename = "diagram-%s.png" % digest
+        image_path = os.path.join(self._image_dir, img_basename)
+        return image_path, img_basename
+
+    def generate_source_path(self, img_dest):
+        """
+        Return the path of the sidecar file which keeps the diagram source
+        next to the generated image.
+        """
+        return os.path.splitext(img_dest)[0] + ".src"
+
+    def is_cached(self, plaintext, img_dest):
+        """
+        Check if the image was already generated from the same plaintext.
+        The file name is only a short hash, so compare the saved source too.
+        """
+        if not os.path.exists(img_dest):
+            return False
+        try:
+            with open(self.generate_source_path(img_dest), encoding="utf-8") as src:
+                return src.read() == plaintext
+        except (IOError, OSError):
+            return False
+
+    def remember(self, img_dest):
+        """
+        Memoize a generated image, evicting the oldest entries if needed.
+        Return relative path to the image.
         """
-        adler32 = ctypes.c_uint32(zlib.adler32(b(plaintext))).value
-        img_basename = "diagram-%x.png" % adler32
-        image_path = os.path.join(self.config['ditaa_image_dir'], img_basename)
-        return image_path
+        with _memo_lock:
+            _memo[img_dest] = None
+            if len(_memo) > MEMO_SIZE:
+                _memo.popitem(last=False)
+        return os.path.relpath(img_dest, self._cwd)
+
+    def copy_image(self, img_dest, img_basename):
+        """
+        Save an extra copy of the image into extra_copy_path.
+        Use a hard link if possible, it costs no I/O.
+        """
+        dst = os.path.join(self._extra_copy, img_basename)
+        if os.path.exists(dst):
+            if os.path.samefile(img_dest, dst):
+                return
+            os.unlink(dst)
+        try:
+            os.link(img_dest, dst)
+        except OSError:
+            # another file system, or hard links are not supported
+            shutil.copy(img_dest, dst)
 
     def generate_diagram(self, plaintext):
         """
         Run ditaa with plaintext input.
-        Return relative path to the generated image.
+        Return relative path to the generated image and its file name.
         """
-        img_dest = self.generate_image_path(plaintext)
+        img_dest, img_basename = self.generate_image_path(plaintext)
 
-        if os.path.exists(img_dest):
-            return os.path.relpath(img_dest, os.getcwd())
+        failed_key = (self._ditaa_cmd, img_dest)
+        failed_at = _failed.get(failed_key)
+        if failed_at is not None and time.time() - failed_at < FAILED_TTL:
+            return None
 
-        src_fd, src_fname = tempfile.mkstemp(prefix="ditaasrc", text=True)
-        out_fd, out_fname = tempfile.mkstemp(prefix="ditaaout", text=True)
-        with os.fdopen(src_fd, "w") as src:
-           src.write(plaintext)
-        try:
-            ditaa_cmd = self.config['ditaa_cmd']
-            cmd = ditaa_cmd.format(infile=src_fname, outfile=img_dest)
-            with os.fdopen(out_fd, "w") as out:
-                retval = subprocess.check_call(cmd.split(), stdout=out)
-
-            if self.config.get('extra_copy_path', None):
-                try:
-                    shutil.copy(img_dest, self.config['extra_copy_path'])
-                except:
-                    pass
-            return os.path.relpath(img_dest, os.getcwd())
+        if img_dest in _memo and os.path.exists(img_dest):
+            return os.path.relpath(img_dest, self._cwd), img_basename
+
+        if self.is_cached(plaintext, img_dest):
+            return self.remember(img_dest), img_basename
 
+        ditaa_cmd = self._ditaa_cmd
+        src = None
+        if "{infile}" in ditaa_cmd:
+            # ditaa reads the diagram from a file rather than from stdin
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", prefix="ditaasrc",
+                                             suffix=".txt", delete=False) as src:
+                src.write(plaintext)
+        try:
+            cmd = ditaa_cmd.format(infile=src and src.name, outfile=img_dest)
+            subprocess.run(cmd.split(), check=True, stdout=subprocess.DEVNULL,
+                           input=None if src else plaintext.encode("utf-8"))
         except Exception as e:
+            logger.warning("ditaa failed to generate %s: %s", img_dest, e)
+            _failed[failed_key] = time.time()
             return None
         finally:
-            os.unlink(src_fname)
-            os.unlink(out_fname)
+            if src:
+                os.unlink(src.name)
+
+        try:
+            with open(self.generate_source_path(img_dest), "w", encoding="utf-8") as sidecar:
+                sidecar.write(plaintext)
+        except OSError:
+            # the image is fine, it is only generated again by the next run
+            pass
+        if self._extra_copy:
+            try:
+                self.copy_image(img_dest, img_basename)
+            except OSError:
+                pass
+        _failed.pop(failed_key, None)
+        return self.remember(img_dest), img_basename
+
+    def generate_diagrams(self, codes):
+        """
+        Run ditaa once for every distinct diagram in codes, in parallel.
+        Return a dict mapping plaintext to the result of generate_diagram().
+        """
+        codes = set(codes)
+        if len(codes) < 2:
+            return dict((c, self.generate_diagram(c)) for c in codes)
+        # ditaa runs in a subprocess, threads are enough
+        workers = min(len(codes), os.cpu_count() or 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = dict((pool.submit(self.generate_diagram, c), c) for c in codes)
+            return dict((futures[f], f.result())
+                        for f in concurrent.futures.as_completed(futures))
 
     def run(self, lines):
-        START_TAG = "```ditaa"
+        self._settings()
+
         END_TAG = "```"
         new_lines = []
+        diagrams = []  # (index in new_lines, prefix, plaintext, path override)
         ditaa_prefix = ""
         ditaa_lines = []
         in_diagram = False
         path_override = None
         for ln in lines:
             if in_diagram:  # lines of a diagram
-                if ln == ditaa_prefix + END_TAG:
-                    # strip line prefix if any (whitespace, bird marks)
-                    plen = len(ditaa_prefix)
-                    ditaa_lines = [dln[plen:] for dln in ditaa_lines]
+                if ln == end_line:
                     ditaa_code = "\n".join(ditaa_lines)
-                    filename = self.generate_diagram(ditaa_code)
-                    if filename:
-                        if path_override:
-                            mkdocs_path = os.path.join(path_override, os.path.basename(filename))
-                        else:
-                            mkdocs_path = os.path.join(self.config['extra_copy_path'], os.path.basename(filename))
-                        new_lines.append(ditaa_prefix + "![%s](%s)" % (mkdocs_path, mkdocs_path))
-                        path_override = None
-                    else:
-                        md_code = [ditaa_prefix + "    " + dln for dln in ditaa_lines]
-                        new_lines.extend([""] + md_code + [""])
+                    # leave a placeholder, the diagram is generated later
+                    diagrams.append((len(new_lines), ditaa_prefix, ditaa_code, path_override))
+                    new_lines.append(None)
                     in_diagram = False
                     ditaa_lines = []
                 else:
-                    ditaa_lines.append(ln)
+                    # strip line prefix if any (whitespace, bird marks)
+                    ditaa_lines.append(ln[plen:] if plen else ln)
             else:  # normal lines
-                start = ln.find(START_TAG)
-                prefix = ln[:start] if start >= 0 else ""
-                postfix = ln[start + len(START_TAG) + 1:] if start >= 0 else ""
-                if postfix and postfix.startswith('path='):
-                    path_override = postfix[5:]
-                    ln = ln[:-len(postfix) - 1]
-
-                # code block may be nested within a list item or a blockquote
-                if start >= 0 and ln.endswith(START_TAG) and not prefix.strip(" \t>"):
+                m = _DITAA_RE.match(ln)
+                if m:
                     in_diagram = True
-                    ditaa_prefix = prefix
+                    ditaa_prefix, path_override = m.groups()
+                    plen = len(ditaa_prefix)
+                    end_line = ditaa_prefix + END_TAG
                 else:
                     new_lines.append(ln)
+
+        filenames = self.generate_diagrams(d[2] for d in diagrams)
+
+        # replace placeholders starting from the end to keep indices valid
+        for idx, ditaa_prefix, ditaa_code, path_override in reversed(diagrams):
+            filename = filenames[ditaa_code]
+            if filename:
+                rel_path, img_basename = filename
+                if path_override:
+                    mkdocs_path = path_override.rstrip("/") + "/" + img_basename
+                elif self._extra_copy:
+                    mkdocs_path = self._extra_copy.rstrip("/") + "/" + img_basename
+                else:
+                    mkdocs_path = rel_path
+                new_lines[idx] = ditaa_prefix + "![%s](%s)" % (mkdocs_path, mkdocs_path)
+            else:
+                # keep the diagram as an indented code block
+                indent = ditaa_prefix + "    "
+                new_lines[idx:idx + 1] = ["", *(indent + dln for dln in ditaa_code.split("\n")), ""]
         return new_lines
 
 
@@ -144,7 +259,7 @@ class DitaaExtension(Extension):
     PreprocessorClass = DitaaPreprocessor
 
     def __init__(self, **kwargs):
-        ditaa_cmd = kwargs.get('ditaa_cmd', 'ditaa {infile} {outfile} --overwrite')
+        ditaa_cmd = kwargs.get('ditaa_cmd', 'ditaa - {outfile} --overwrite')
         ditaa_image_dir = kwargs.get('ditaa_image_dir', '.')
         extra_copy_path = kwargs.get('extra_copy_path', None)
 
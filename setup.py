@@ -4,4 +4,5 @@ setup(
     version='0.3',
     py_modules=['mdx_ditaa'],
     install_requires = ['markdown>=2.5'],
+    python_requires='>=3.6',
 )
@@ -1,7 +1,34 @@
 from __future__ import unicode_literals
 import markdown as md
 from nose.tools import assert_equal
+import contextlib
+import errno
 import os
+import shutil
+import sys
+import tempfile
+from unittest import mock
+
+import mdx_ditaa
+
+
+# Stands in for ditaa: copies the diagram source to the output file, logs the
+# input file name, and fails on diagrams containing FAIL.
+STUB_DITAA = """\
+import sys
+src, dst, log = sys.argv[1:4]
+if src == "-":
+    text = sys.stdin.buffer.read()
+else:
+    with open(src, "rb") as f:
+        text = f.read()
+with open(log, "a") as f:
+    f.write(src + "\\n")
+if b"FAIL" in text:
+    sys.exit(1)
+with open(dst, "wb") as f:
+    f.write(text)
+"""
 
 
 def test_with_fenced_code():
@@ -22,15 +49,232 @@ def test_with_fenced_code():
          "```"])
 
     html = md.markdown(markdown_source, extensions=["fenced_code", "ditaa"])
-    if os.path.exists("diagram-1d900348.png"):
-        os.unlink("diagram-1d900348.png")
+    for fname in ["diagram-d10cec8fa8b6bd6d.png", "diagram-d10cec8fa8b6bd6d.src"]:
+        if os.path.exists(fname):
+            os.unlink(fname)
 
     expected_html = "\n".join(
         ['<p>Test diagram:</p>',
-         '<p><img alt="diagram-1d900348.png" src="diagram-1d900348.png" /></p>',
+         '<p><img alt="diagram-d10cec8fa8b6bd6d.png" src="diagram-d10cec8fa8b6bd6d.png" /></p>',
          '<p>Test code:</p>',
          '<pre><code class="python">def f():',
          '    pass',
          '</code></pre>'])
 
     assert_equal(html, expected_html)
+
+
+@contextlib.contextmanager
+def workdir():
+    """
+    Run a test in a new current directory with empty process-wide caches.
+    """
+    old_cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp(prefix="ditaatest")
+    with open(os.path.join(tmpdir, "stub.py"), "w") as f:
+        f.write(STUB_DITAA)
+    os.mkdir(os.path.join(tmpdir, "extra"))
+    mdx_ditaa._memo.clear()
+    mdx_ditaa._failed.clear()
+    os.chdir(tmpdir)
+    try:
+        yield tmpdir
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(tmpdir)
+
+
+def make_preprocessor(tmpdir, infile="{infile}", extra_copy_path="extra"):
+    ditaa_cmd = " ".join([sys.executable, os.path.join(tmpdir, "stub.py"),
+                          infile, "{outfile}", os.path.join(tmpdir, "calls.log")])
+    ditaa = mdx_ditaa.DitaaPreprocessor()
+    ditaa.config = {'ditaa_cmd': ditaa_cmd,
+                    'ditaa_image_dir': tmpdir,
+                    'extra_copy_path': extra_copy_path}
+    return ditaa
+
+
+def ditaa_calls(tmpdir):
+    log = os.path.join(tmpdir, "calls.log")
+    if not os.path.exists(log):
+        return []
+    with open(log) as f:
+        return f.read().splitlines()
+
+
+def image_name(tmpdir, plaintext):
+    return make_preprocessor(tmpdir).generate_image_path(plaintext)[1]
+
+
+def image_link(path):
+    return "![%s](%s)" % (path, path)
+
+
+DIAGRAM = ["```ditaa", "+-+", "```"]
+
+
+def test_sidecar_cache():
+    with workdir() as tmpdir:
+        img = image_name(tmpdir, "+-+")
+        assert_equal(make_preprocessor(tmpdir).run(DIAGRAM), [image_link("extra/" + img)])
+        assert_equal(len(ditaa_calls(tmpdir)), 1)
+
+        # image and matching source on disk: ditaa is not run again
+        mdx_ditaa._memo.clear()
+        assert_equal(make_preprocessor(tmpdir).run(DIAGRAM), [image_link("extra/" + img)])
+        assert_equal(len(ditaa_calls(tmpdir)), 1)
+
+        # the source does not match: the image is generated again
+        mdx_ditaa._memo.clear()
+        with open(img[:-len(".png")] + ".src", "w") as f:
+            f.write("+--+")
+        make_preprocessor(tmpdir).run(DIAGRAM)
+        assert_equal(len(ditaa_calls(tmpdir)), 2)
+
+
+def test_sidecar_write_failure():
+    with workdir() as tmpdir:
+        img = image_name(tmpdir, "+-+")
+        os.mkdir(img[:-len(".png")] + ".src")
+        assert_equal(make_preprocessor(tmpdir).run(DIAGRAM), [image_link("extra/" + img)])
+
+
+def test_non_ascii_diagram():
+    with workdir() as tmpdir:
+        diagram = "┌─┐ café"
+        img = image_name(tmpdir, diagram)
+        lines = ["```ditaa", diagram, "```"]
+        assert_equal(make_preprocessor(tmpdir).run(lines), [image_link("extra/" + img)])
+        with open(img[:-len(".png")] + ".src", "rb") as f:
+            assert_equal(f.read(), diagram.encode("utf-8"))
+        with open(img, "rb") as f:
+            assert_equal(f.read(), diagram.encode("utf-8"))
+
+        # the saved source matches on the next run
+        mdx_ditaa._memo.clear()
+        make_preprocessor(tmpdir).run(lines)
+        assert_equal(len(ditaa_calls(tmpdir)), 1)
+
+
+def test_memo():
+    with workdir() as tmpdir:
+        img = image_name(tmpdir, "+-+")
+        assert_equal(make_preprocessor(tmpdir).generate_diagram("+-+"), (img, img))
+        # the memo is used even without the saved source
+        os.unlink(img[:-len(".png")] + ".src")
+        make_preprocessor(tmpdir).run(DIAGRAM)
+        assert_equal(len(ditaa_calls(tmpdir)), 1)
+
+        # paths are relative to the current directory of each call
+        os.mkdir("sub")
+        os.chdir("sub")
+        assert_equal(make_preprocessor(tmpdir).generate_diagram("+-+"), ("../" + img, img))
+
+
+def test_order_and_duplicates():
+    with workdir() as tmpdir:
+        img_a = image_name(tmpdir, "A")
+        img_b = image_name(tmpdir, "B")
+        lines = ["one", "```ditaa", "A", "```", "two",
+                 "```ditaa", "B", "```", "three",
+                 "```ditaa", "A", "```", "four"]
+        assert_equal(make_preprocessor(tmpdir).run(lines),
+                     ["one", image_link("extra/" + img_a), "two",
+                      image_link("extra/" + img_b), "three",
+                      image_link("extra/" + img_a), "four"])
+        assert_equal(len(ditaa_calls(tmpdir)), 2)
+
+
+def test_many_diagrams():
+    with workdir() as tmpdir:
+        codes = ["+%s+" % ("-" * i) for i in range(1, 9)]
+        lines = []
+        for code in codes:
+            lines.extend(["```ditaa", code, "```"])
+        expected = [image_link("extra/" + image_name(tmpdir, code)) for code in codes]
+        assert_equal(make_preprocessor(tmpdir).run(lines), expected)
+        assert_equal(len(ditaa_calls(tmpdir)), len(codes))
+
+
+def test_opening_line():
+    with workdir() as tmpdir:
+        img = image_name(tmpdir, "+-+")
+        link = image_link("extra/" + img)
+        ditaa = make_preprocessor(tmpdir)
+        # nested in a list item or a blockquote
+        assert_equal(ditaa.run(["  ```ditaa", "  +-+", "  ```"]), ["  " + link])
+        assert_equal(ditaa.run(["> ```ditaa", "> +-+", "> ```"]), ["> " + link])
+        # trailing whitespace
+        assert_equal(ditaa.run(["```ditaa \t", "+-+", "```"]), [link])
+        # path override, which may contain spaces
+        assert_equal(ditaa.run(["```ditaa path=img", "+-+", "```"]),
+                     [image_link("img/" + img)])
+        assert_equal(ditaa.run(["```ditaa path=my dir ", "+-+", "```"]),
+                     [image_link("my dir/" + img)])
+        # not a ditaa block
+        lines = ["```ditaa extra", "+-+", "```", "text ```ditaa"]
+        assert_equal(ditaa.run(lines), lines)
+
+
+def test_failed_diagram():
+    with workdir() as tmpdir:
+        lines = ["> ```ditaa", "> +-+", "> FAIL", "> ```", "> text"]
+        expected = ["", ">     +-+", ">     FAIL", "", "> text"]
+        assert_equal(make_preprocessor(tmpdir).run(lines), expected)
+        assert_equal(len(ditaa_calls(tmpdir)), 1)
+
+        # the failure is remembered
+        assert_equal(make_preprocessor(tmpdir).run(lines), expected)
+        assert_equal(len(ditaa_calls(tmpdir)), 1)
+
+        # but not for another ditaa command, or after FAILED_TTL
+        make_preprocessor(tmpdir, infile="-").run(lines)
+        assert_equal(len(ditaa_calls(tmpdir)), 2)
+        with mock.patch.object(mdx_ditaa, "FAILED_TTL", 0):
+            make_preprocessor(tmpdir).run(lines)
+        assert_equal(len(ditaa_calls(tmpdir)), 3)
+
+
+def test_stdin_and_infile():
+    with workdir() as tmpdir:
+        make_preprocessor(tmpdir, infile="-").run(["```ditaa", "A", "```"])
+        make_preprocessor(tmpdir).run(["```ditaa", "B", "```"])
+        stdin_call, infile_call = ditaa_calls(tmpdir)
+        assert_equal(stdin_call, "-")
+        assert infile_call != "-"
+        # the temporary source file is removed
+        assert not os.path.exists(infile_call)
+        with open(image_name(tmpdir, "B")) as f:
+            assert_equal(f.read(), "B")
+
+
+def test_image_path_before_run():
+    with workdir() as tmpdir:
+        img_dest, img_basename = make_preprocessor(tmpdir).generate_image_path("+-+")
+        assert_equal(img_dest, os.path.join(tmpdir, img_basename))
+
+
+def test_extra_copy_hardlink():
+    with workdir() as tmpdir:
+        img = image_name(tmpdir, "+-+")
+        make_preprocessor(tmpdir).run(DIAGRAM)
+        assert os.path.samefile(img, os.path.join("extra", img))
+
+
+def test_extra_copy_fallback():
+    with workdir() as tmpdir:
+        img = image_name(tmpdir, "+-+")
+        cross_device = OSError(errno.EXDEV, "Invalid cross-device link")
+        with mock.patch("os.link", side_effect=cross_device):
+            make_preprocessor(tmpdir).run(DIAGRAM)
+        assert os.path.exists(os.path.join("extra", img))
+        assert not os.path.samefile(img, os.path.join("extra", img))
+
+
+def test_link_paths():
+    with workdir() as tmpdir:
+        img = image_name(tmpdir, "+-+")
+        ditaa = make_preprocessor(tmpdir, extra_copy_path=None)
+        assert_equal(ditaa.run(DIAGRAM), [image_link(img)])
+        assert_equal(ditaa.run(["```ditaa path=img/", "+-+", "```"]),
+                     [image_link("img/" + img)])